@@ -1,20 +1,51 @@
 import os
 import asyncio
+import atexit
+import hashlib
 import logging
+import logging.handlers
+import queue
+import re
+import time
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from functools import lru_cache
 
 from telethon import TelegramClient, events
+from telethon.errors import FloodWaitError
 from telethon.sessions import StringSession
-from telethon.sync import TelegramClient as SyncTelegramClient
 from dotenv import load_dotenv
-from openai import OpenAI
-from flask import Flask, render_template_string, request, redirect, url_for, flash
-import psycopg2
+from openai import AsyncOpenAI
+from jinja2 import DictLoader
+from flask import Flask, Response, request, redirect, url_for, flash, make_response, stream_with_context
+from psycopg2.extensions import connection
+from psycopg2.extras import Json, RealDictCursor, execute_values
+from psycopg2.pool import ThreadedConnectionPool
+import uvloop
 
 # --- базовая настройка ---
 
 load_dotenv()
 
-logging.basicConfig(level=logging.INFO)
+# логи пишем через очередь: в обработчиках остаётся только put, а сама запись
+# в stderr (на Heroku это pipe в logplex) идёт в отдельном потоке и не тормозит loop
+log_queue = queue.Queue(-1)
+log_listener = None
+
+_root_logger = logging.getLogger()
+if not _root_logger.handlers:
+    _log_stream = logging.StreamHandler()
+    _log_stream.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    log_listener = logging.handlers.QueueListener(log_queue, _log_stream, respect_handler_level=True)
+    log_listener.start()
+    # регистрируем первым: atexit идёт в обратном порядке, так что очередь
+    # дочитается уже после логов остальных хуков завершения
+    atexit.register(log_listener.stop)
+    _root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    _root_logger.setLevel(logging.INFO)
+
 logger = logging.getLogger("tg-agent")
 
 TG_API_ID_RAW = os.getenv("TG_API_ID", "0")
@@ -24,6 +55,15 @@ TG_SESSION = os.getenv("TG_SESSION")
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4.1-mini")
+# дешёвая модель для сжатия старых реплик диалога в резюме
+OPENAI_SUMMARY_MODEL = os.getenv("OPENAI_SUMMARY_MODEL", "gpt-4.1-nano")
+# ограничения на запросы к OpenAI, чтобы пачка сообщений не упиралась в 429
+OPENAI_CONCURRENCY = int(os.getenv("OPENAI_CONCURRENCY", "8"))
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", "0"))  # 0 — без ограничения по RPM
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "5"))
+# таймаут одного запроса (сек): по умолчанию у SDK 10 минут, и зависший запрос
+# надолго занимает слот OPENAI_CONCURRENCY
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
 
 # env по умолчанию (на случай, если БД нет)
 TARGET_IDS_RAW = os.getenv("TARGET_IDS", "")
@@ -39,30 +79,213 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 # список chat_id, которым ОН НЕ ДОЛЖЕН ОТВЕЧАТЬ (через запятую)
 IGNORE_CHAT_IDS_RAW = os.getenv("IGNORE_CHAT_IDS", "")
 
-REQUIRED_OK = all([TG_API_ID, TG_API_HASH, TG_SESSION, OPENAI_API_KEY])
+# сколько секунд держим тезисы и настройки рассылки из БД в памяти, прежде чем перечитать
+PROMPT_CACHE_TTL = int(os.getenv("PROMPT_CACHE_TTL", "30"))
+SETTINGS_CACHE_TTL = int(os.getenv("SETTINGS_CACHE_TTL", "30"))
+
+# env в процессе не меняются — проверяем один раз
+HAS_TG_CREDS = bool(TG_API_ID and TG_API_HASH and TG_SESSION)
+REQUIRED_OK = HAS_TG_CREDS and bool(OPENAI_API_KEY)
 
 # --- OpenAI ---
 
+# асинхронный клиент: запрос к модели не блокирует event loop Telethon,
+# и несколько входящих сообщений обрабатываются параллельно
+# на 429/5xx SDK сам повторяет запрос с экспоненциальной паузой и учитывает Retry-After
 oa_client = None
 if OPENAI_API_KEY:
-    oa_client = OpenAI(api_key=OPENAI_API_KEY)
+    oa_client = AsyncOpenAI(
+        api_key=OPENAI_API_KEY,
+        max_retries=OPENAI_MAX_RETRIES,
+        timeout=OPENAI_TIMEOUT,
+    )
+
+# не больше OPENAI_CONCURRENCY запросов к модели одновременно
+openai_sem = asyncio.Semaphore(OPENAI_CONCURRENCY)
+# когда можно стартовать следующий запрос при заданном OPENAI_RPM
+openai_pace = {"next": 0.0}
 
 # --- Telethon (user-аккаунт, не бот) ---
 
 client = None
-if TG_API_ID and TG_API_HASH and TG_SESSION:
+if HAS_TG_CREDS:
     client = TelegramClient(StringSession(TG_SESSION), TG_API_ID, TG_API_HASH)
 
-# Память диалогов в RAM: chat_id -> [messages]
-dialogues = {}
+# сколько отправок рассылки идёт одновременно и сколько сообщений в секунду
+# (у Telegram потолок порядка 30/с; 0 — без ограничения по скорости)
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "25"))
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "30"))
+# FloodWait не дольше стольких секунд пережидаем и повторяем отправку, дольше — считаем ошибкой
+BROADCAST_FLOOD_MAX_WAIT = 60
+# сколько диалогов подтягиваем перед рассылкой, чтобы знать имена/типы целей без get_entity
+BROADCAST_DIALOGS_LIMIT = 500
+
+# сколько последних сообщений диалога помним и отправляем в модель
+DIALOGUE_WINDOW = int(os.getenv("DLG_WINDOW", "10"))
+# и сколько символов истории максимум уходит в модель вместе с новой репликой:
+# длинные ответы раздувают промпт сильнее, чем число сообщений
+DIALOGUE_MAX_CHARS = int(os.getenv("DLG_MAX_CHARS", "8000"))
+
+# сколько разных чатов держим в памяти; дольше всех молчавшие вытесняются первыми
+DIALOGUE_MAX_CHATS = int(os.getenv("DLG_MAX_CHATS", "1000"))
+# и сколько секунд молчания чат держим в памяти (его память всё равно лежит в БД
+# и подтянется при следующем сообщении)
+DIALOGUE_IDLE_TTL = int(os.getenv("DLG_IDLE_TTL", "3600"))
+# а в БД память чата живёт столько дней после последнего сообщения (0 — бессрочно)
+DIALOGUE_MEMORY_DAYS = int(os.getenv("DLG_MEMORY_DAYS", "30"))
+
+# стриминг ответа: после скольких символов отправляем первое сообщение
+# и как часто (сек) его редактируем, чтобы не ловить flood-wait от Telegram
+STREAM_FIRST_CHARS = 200
+STREAM_EDIT_INTERVAL = 1.5
+
+# сколько самых старых реплик за раз сжимаем в резюме, когда окно заполнено
+DIALOGUE_SUMMARIZE_BATCH = 4
+
+SUMMARY_PROMPT = (
+    "Ты ведёшь краткое резюме переписки. Объедини прежнее резюме и новые реплики "
+    "в одно короткое резюме на русском: факты о собеседнике, договорённости, открытые вопросы. "
+    "Без вступлений, не больше 5 предложений."
+)
+
+# Память диалогов в RAM (LRU): chat_id -> {"summary": str, "recent": deque(messages), ...}
+#   recent    — последние реплики дословно (не больше DIALOGUE_WINDOW)
+#   summary   — сжатое резюме всего, что из окна уже ушло
+#   pending   — тексты, на которые ответ ещё готовится, чтобы отсеивать дубли
+#   loaded    — память уже подтянута из dialogue_memory (после рестарта / вытеснения)
+#   loading   — задача, которая её сейчас подтягивает (её ждут все сообщения чата)
+dialogues = OrderedDict()
+
+# фоновые задачи (сохранение памяти диалогов и т.п.), см. run_in_background
+background_tasks = set()
+
+# кэш ответов на короткие первые реплики (LRU):
+# (hash тезисов, нормализованный текст) -> (ответ, когда протухает)
+REPLY_CACHE_SIZE = 2048
+REPLY_CACHE_MAX_LEN = 120
+# ответ из кэша не должен жить вечно: модель/тезисы те же, но приветствие со временем хочется освежить
+REPLY_CACHE_TTL = int(os.getenv("REPLY_CACHE_TTL", "3600"))
+reply_cache = OrderedDict()
+# для ключа кэша пунктуация и регистр не важны: "Привет!", "привет" и "ПРИВЕТ..." — одна реплика
+_REPLY_PUNCT_RE = re.compile(r"[^\w\s]+")
+
+# Пул соединений с Postgres (см. get_db_pool): держим до PG_POOL_MIN простаивающих
+# соединений, одновременно открыто не больше PG_POOL_MAX
+PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", "2"))
+PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", "8"))
+# предел на один SQL-запрос, мс: зависший Postgres не держит поток и соединение пула (0 — без предела)
+PG_STATEMENT_TIMEOUT_MS = int(os.getenv("PG_STATEMENT_TIMEOUT_MS", "2000"))
+db_pool = None
+db_pool_lock = threading.Lock()
+db_pool_slots = threading.BoundedSemaphore(PG_POOL_MAX)
+
+# Таблицы созданы (см. ensure_db)
+db_ready = {"done": False}
+db_ready_lock = threading.Lock()
+# ключ pg_advisory_xact_lock для init_db: web и worker'ы (их может быть несколько)
+# создают и мигрируют схему по очереди, а не наперегонки
+INIT_DB_LOCK_ID = 7_351_001
+
+# Тезисы и настройки рассылки из БД, закэшированные на *_CACHE_TTL секунд
+# (блокировки — чтобы промах кэша шёл в БД один раз, а не из каждого потока)
+_prompt_cache = {"value": None, "version": None, "expires": 0.0}
+_prompt_cache_lock = threading.Lock()
+_settings_cache = {"value": None, "expires": 0.0}
+_settings_cache_lock = threading.Lock()
 
 
 # --- Работа с базой (тезисы, настройки рассылки, история рассылок) ---
 
-def get_db_conn():
+class PreparingConnection(connection):
+    """
+    Соединение помнит, какие запросы на нём уже подготовлены через PREPARE:
+    подготовленный запрос живёт в сессии Postgres, то есть у каждого соединения пула свой.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+def execute_prepared(cur, name: str, sql: str, params):
+    """
+    Горячие запросы (память диалога на каждое сообщение) Postgres разбирает
+    и планирует один раз на соединение, дальше — только EXECUTE с параметрами.
+    sql пишется с $1, $2, ... вместо %s.
+    """
+    conn = cur.connection
+    if name not in conn.prepared:
+        cur.execute(f"PREPARE {name} AS {sql}")
+        conn.prepared.add(name)
+    cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+
+
+def get_db_pool():
+    """
+    Пул соединений создаётся лениво, один на процесс (web и worker — разные процессы).
+    Так TCP+TLS-хендшейк к Postgres делается один раз, а не на каждый запрос.
+    """
+    global db_pool
     if not DATABASE_URL:
         return None
-    return psycopg2.connect(DATABASE_URL, sslmode="require")
+    with db_pool_lock:
+        if db_pool is None:
+            db_pool = ThreadedConnectionPool(
+                PG_POOL_MIN,
+                PG_POOL_MAX,
+                DATABASE_URL,
+                sslmode="require",
+                connection_factory=PreparingConnection,
+                options=f"-c statement_timeout={PG_STATEMENT_TIMEOUT_MS}",
+                # TCP keepalive: оборванное соединение (рестарт Postgres, сеть Heroku)
+                # обнаруживается само, а не первым упавшим запросом
+                keepalives=1,
+                keepalives_idle=30,
+                keepalives_interval=10,
+                keepalives_count=3,
+            )
+    return db_pool
+
+
+def close_db_pool():
+    # при остановке процесса закрываем соединения сами, а не обрываем их —
+    # Postgres не держит «висящие» бэкенды до таймаута
+    with db_pool_lock:
+        if db_pool is not None and not db_pool.closed:
+            db_pool.closeall()
+
+
+# регистрируем раньше остальных atexit-хуков: они срабатывают в обратном порядке,
+# так что пул закроется последним, после дописывания лога рассылки
+atexit.register(close_db_pool)
+
+
+@contextmanager
+def db_conn(autocommit: bool = False):
+    """
+    Берём соединение из пула и обязательно возвращаем его обратно.
+    Если DATABASE_URL не задан — отдаём None, вызывающий сам решает, что делать.
+    Когда все PG_POOL_MAX соединений заняты, ждём свободное (ThreadedConnectionPool
+    в этом случае сразу бросает PoolError).
+    autocommit=True — для чтений из одного SELECT: без BEGIN/COMMIT, то есть без
+    лишнего round-trip. Записи берут соединение как есть и коммитят через `with conn:`.
+    """
+    pool = get_db_pool()
+    if pool is None:
+        yield None
+        return
+
+    with db_pool_slots:
+        conn = pool.getconn()
+        try:
+            conn.autocommit = autocommit
+            yield conn
+        finally:
+            if autocommit and not conn.closed:
+                # в пул соединение возвращается в обычном, транзакционном режиме
+                conn.autocommit = False
+            # разорванное соединение в пул не возвращаем — следующий получит новое
+            pool.putconn(conn, close=bool(conn.closed))
 
 
 def init_db():
@@ -71,39 +294,42 @@ def init_db():
       - ai_prompt      (тезисы для ИИ)
       - agent_settings (настройки рассылки)
       - broadcast_log  (история рассылок)
+      - dialogue_memory (память диалогов worker'а: резюме + последние реплики)
     """
-    conn = get_db_conn()
-    if conn is None:
-        logger.warning("DATABASE_URL не задан, БД-функции (тезисы/рассылка/лог) работать не будут.")
-        return
+    with db_conn() as conn:
+        if conn is None:
+            logger.warning("DATABASE_URL не задан, БД-функции (тезисы/рассылка/лог) работать не будут.")
+            return
 
-    try:
         with conn:
             with conn.cursor() as cur:
-                # Тезисы для ИИ
+                # Вся схема — одним запросом (один round-trip вместо пяти).
+                # Процессы, стартующие одновременно, ждут друг друга на advisory lock
+                # (иначе их DDL и seed-вставки взаимно блокируются), поэтому
+                # statement_timeout на эту транзакцию снимаем.
                 cur.execute(
                     """
+                    SET LOCAL statement_timeout = 0;
+                    SELECT pg_advisory_xact_lock(%s);
+
+                    -- Тезисы для ИИ
                     CREATE TABLE IF NOT EXISTS ai_prompt (
-                        id SERIAL PRIMARY KEY,
+                        id INT PRIMARY KEY DEFAULT 1 CONSTRAINT ai_prompt_singleton CHECK (id = 1),
                         content TEXT NOT NULL,
+                        -- растёт на каждое сохранение: по нему понимаем, что тезисы не менялись
+                        version BIGINT NOT NULL DEFAULT 1,
                         updated_at TIMESTAMPTZ DEFAULT NOW()
                     );
-                    """
-                )
-                # Настройки рассылки
-                cur.execute(
-                    """
+
+                    -- Настройки рассылки
                     CREATE TABLE IF NOT EXISTS agent_settings (
-                        id SERIAL PRIMARY KEY,
+                        id INT PRIMARY KEY DEFAULT 1 CONSTRAINT agent_settings_singleton CHECK (id = 1),
                         target_ids TEXT,
                         start_message TEXT,
                         updated_at TIMESTAMPTZ DEFAULT NOW()
                     );
-                    """
-                )
-                # История рассылок
-                cur.execute(
-                    """
+
+                    -- История рассылок
                     CREATE TABLE IF NOT EXISTS broadcast_log (
                         id SERIAL PRIMARY KEY,
                         chat_id BIGINT,
@@ -114,235 +340,714 @@ def init_db():
                         error TEXT,
                         sent_at TIMESTAMPTZ DEFAULT NOW()
                     );
-                    """
+                    -- /broadcast показывает последние записи — без индекса это seq scan + sort всей истории
+                    CREATE INDEX IF NOT EXISTS broadcast_log_sent_at_desc_idx ON broadcast_log (sent_at DESC);
+
+                    -- Память диалогов, переживает рестарт worker'а
+                    CREATE TABLE IF NOT EXISTS dialogue_memory (
+                        chat_id BIGINT PRIMARY KEY,
+                        summary TEXT NOT NULL DEFAULT '',
+                        recent JSONB NOT NULL DEFAULT '[]',
+                        updated_at TIMESTAMPTZ DEFAULT NOW()
+                    );
+                    -- для ежечасной чистки устаревшей памяти (prune_dialogue_memory)
+                    CREATE INDEX IF NOT EXISTS dialogue_memory_updated_at_idx ON dialogue_memory (updated_at);
+                    """,
+                    (INIT_DB_LOCK_ID,),
                 )
 
-                # Стартовая запись для ai_prompt
-                cur.execute("SELECT id FROM ai_prompt LIMIT 1;")
-                row = cur.fetchone()
-                if row is None:
-                    cur.execute(
-                        "INSERT INTO ai_prompt (content) VALUES (%s);",
-                        (SYSTEM_PROMPT,),
-                    )
+                # Стартовая запись для ai_prompt: тезисы всегда живут в строке id=1.
+                # Если раньше запись была под другим id — переносим её текст.
+                cur.execute(
+                    """
+                    INSERT INTO ai_prompt (id, content)
+                    SELECT 1, COALESCE((SELECT content FROM ai_prompt ORDER BY id LIMIT 1), %s)
+                    ON CONFLICT (id) DO NOTHING;
+                    """,
+                    (SYSTEM_PROMPT,),
+                )
+                if cur.rowcount:
                     logger.info("Создана стартовая запись ai_prompt.")
 
-                # Стартовая запись для agent_settings
-                cur.execute("SELECT id FROM agent_settings LIMIT 1;")
-                row = cur.fetchone()
-                if row is None:
-                    cur.execute(
-                        "INSERT INTO agent_settings (target_ids, start_message) VALUES (%s, %s);",
-                        (TARGET_IDS_RAW, START_MESSAGE),
-                    )
+                # Стартовая запись для agent_settings — так же, в строке id=1
+                cur.execute(
+                    """
+                    INSERT INTO agent_settings (id, target_ids, start_message)
+                    SELECT 1, target_ids, start_message
+                      FROM (SELECT 0 AS src, id, target_ids, start_message FROM agent_settings
+                            UNION ALL
+                            SELECT 1, 0, %s, %s) AS candidates
+                  ORDER BY src, id
+                     LIMIT 1
+                    ON CONFLICT (id) DO NOTHING;
+                    """,
+                    (TARGET_IDS_RAW, START_MESSAGE),
+                )
+                if cur.rowcount:
                     logger.info("Создана стартовая запись agent_settings.")
-    finally:
-        conn.close()
+
+                # Таблицы, созданные до перехода на одну строку (id SERIAL), приводим к тому же
+                # виду: прежние строки уже перенесены в id=1 выше, CHECK не даст появиться новым.
+                # Каждый шаг — только если схема ещё старая: на актуальной ALTER TABLE
+                # не выполняется и эксклюзивных блокировок при старте не берётся
+                cur.execute(
+                    """
+                    DO $$
+                    BEGIN
+                        IF EXISTS (SELECT 1 FROM ai_prompt WHERE id <> 1) THEN
+                            DELETE FROM ai_prompt WHERE id <> 1;
+                        END IF;
+                        IF EXISTS (SELECT 1 FROM agent_settings WHERE id <> 1) THEN
+                            DELETE FROM agent_settings WHERE id <> 1;
+                        END IF;
+                        IF NOT EXISTS (SELECT 1 FROM information_schema.columns
+                                        WHERE table_schema = current_schema() AND table_name = 'ai_prompt'
+                                          AND column_name = 'id' AND column_default = '1') THEN
+                            ALTER TABLE ai_prompt ALTER COLUMN id SET DEFAULT 1;
+                        END IF;
+                        IF NOT EXISTS (SELECT 1 FROM information_schema.columns
+                                        WHERE table_schema = current_schema() AND table_name = 'agent_settings'
+                                          AND column_name = 'id' AND column_default = '1') THEN
+                            ALTER TABLE agent_settings ALTER COLUMN id SET DEFAULT 1;
+                        END IF;
+                        IF NOT EXISTS (SELECT 1 FROM information_schema.columns
+                                        WHERE table_schema = current_schema() AND table_name = 'ai_prompt'
+                                          AND column_name = 'version') THEN
+                            ALTER TABLE ai_prompt ADD COLUMN version BIGINT NOT NULL DEFAULT 1;
+                        END IF;
+                        IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'ai_prompt_singleton') THEN
+                            ALTER TABLE ai_prompt ADD CONSTRAINT ai_prompt_singleton CHECK (id = 1);
+                        END IF;
+                        IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'agent_settings_singleton') THEN
+                            ALTER TABLE agent_settings ADD CONSTRAINT agent_settings_singleton CHECK (id = 1);
+                        END IF;
+                    END $$;
+                    """
+                )
 
 
 def get_prompt_from_db():
-    conn = get_db_conn()
-    if conn is None:
-        return None
+    """
+    Тезисы читаются на каждое сообщение, а меняются редко — держим их
+    в _prompt_cache PROMPT_CACHE_TTL секунд (set_prompt_in_db обновляет кэш сам).
+    Когда срок истёк, сверяем version: если тезисы не менялись, БД возвращает
+    только номер версии, а сам текст заново не передаётся.
+    """
+    if time.monotonic() < _prompt_cache["expires"]:
+        return _prompt_cache["value"]
+
+    with _prompt_cache_lock:
+        # пока ждали блокировку, кэш мог наполнить другой поток
+        now = time.monotonic()
+        if now < _prompt_cache["expires"]:
+            return _prompt_cache["value"]
+
+        with db_conn(autocommit=True) as conn:
+            if conn is None:
+                return None
 
-    try:
-        with conn:
             with conn.cursor() as cur:
-                cur.execute("SELECT content FROM ai_prompt ORDER BY id LIMIT 1;")
+                # content NOT NULL, так что NULL здесь значит «версия та же, текст в кэше»
+                cur.execute(
+                    """
+                    SELECT version,
+                           CASE WHEN version = %s THEN NULL ELSE content END
+                      FROM ai_prompt WHERE id = 1;
+                    """,
+                    (_prompt_cache["version"],),
+                )
                 row = cur.fetchone()
-                if row:
-                    return row[0]
-                return None
-    finally:
-        conn.close()
 
+        if row is None:
+            _prompt_cache["value"] = _prompt_cache["version"] = None
+        elif row[1] is not None:
+            _prompt_cache["version"], _prompt_cache["value"] = row
+        _prompt_cache["expires"] = now + PROMPT_CACHE_TTL
+        return _prompt_cache["value"]
 
-def set_prompt_in_db(text: str):
-    conn = get_db_conn()
-    if conn is None:
-        raise RuntimeError("DATABASE_URL не задан, некуда сохранить тезисы.")
 
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT id FROM ai_prompt ORDER BY id LIMIT 1;")
-                row = cur.fetchone()
-                if row:
-                    cur.execute(
-                        "UPDATE ai_prompt SET content=%s, updated_at=NOW() WHERE id=%s;",
-                        (text, row[0]),
-                    )
-                else:
+def set_prompt_in_db(text: str):
+    # под той же блокировкой, что и чтение: запоздавший SELECT не затрёт новые тезисы в кэше
+    with _prompt_cache_lock:
+        with db_conn() as conn:
+            if conn is None:
+                raise RuntimeError("DATABASE_URL не задан, некуда сохранить тезисы.")
+
+            with conn:
+                with conn.cursor() as cur:
+                    # один запрос вместо SELECT + UPDATE/INSERT
                     cur.execute(
-                        "INSERT INTO ai_prompt (content) VALUES (%s);",
+                        """
+                        INSERT INTO ai_prompt (id, content) VALUES (1, %s)
+                        ON CONFLICT (id) DO UPDATE
+                           SET content = EXCLUDED.content,
+                               version = ai_prompt.version + 1,
+                               updated_at = NOW()
+                        RETURNING version;
+                        """,
                         (text,),
                     )
-    finally:
-        conn.close()
+                    version = cur.fetchone()[0]
+        # записанное сразу кладём в кэш — следующему чтению БД не нужна
+        _prompt_cache["value"] = text
+        _prompt_cache["version"] = version
+        _prompt_cache["expires"] = time.monotonic() + PROMPT_CACHE_TTL
 
 
 def get_agent_settings():
     """
-    Берём текущие TARGET_IDS и START_MESSAGE из БД.
+    Берём текущие TARGET_IDS и START_MESSAGE из БД (с кэшем на SETTINGS_CACHE_TTL секунд).
     Если БД нет или записи нет — возвращаем значения из env.
     """
-    conn = get_db_conn()
-    if conn is None:
-        return TARGET_IDS_RAW, START_MESSAGE
+    if time.monotonic() < _settings_cache["expires"]:
+        return _settings_cache["value"]
+
+    with _settings_cache_lock:
+        now = time.monotonic()
+        if now < _settings_cache["expires"]:
+            return _settings_cache["value"]
+
+        with db_conn(autocommit=True) as conn:
+            if conn is None:
+                return TARGET_IDS_RAW, START_MESSAGE
 
-    try:
-        with conn:
             with conn.cursor() as cur:
                 cur.execute(
-                    "SELECT target_ids, start_message FROM agent_settings ORDER BY id LIMIT 1;"
+                    "SELECT target_ids, start_message FROM agent_settings WHERE id = 1;"
                 )
                 row = cur.fetchone()
-                if row:
-                    return row[0] or "", row[1] or ""
-                else:
-                    return TARGET_IDS_RAW, START_MESSAGE
-    finally:
-        conn.close()
 
+        value = (row[0] or "", row[1] or "") if row else (TARGET_IDS_RAW, START_MESSAGE)
+        _settings_cache["value"] = value
+        _settings_cache["expires"] = now + SETTINGS_CACHE_TTL
+        return value
 
-def set_agent_settings(target_ids: str, start_message: str):
-    conn = get_db_conn()
-    if conn is None:
-        raise RuntimeError("DATABASE_URL не задан, некуда сохранить настройки рассылки.")
 
-    try:
-        with conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT id FROM agent_settings ORDER BY id LIMIT 1;")
-                row = cur.fetchone()
-                if row:
+def set_agent_settings(target_ids: str, start_message: str):
+    with _settings_cache_lock:
+        with db_conn() as conn:
+            if conn is None:
+                raise RuntimeError("DATABASE_URL не задан, некуда сохранить настройки рассылки.")
+
+            with conn:
+                with conn.cursor() as cur:
+                    # один запрос вместо SELECT + UPDATE/INSERT
                     cur.execute(
                         """
-                        UPDATE agent_settings
-                           SET target_ids=%s,
-                               start_message=%s,
-                               updated_at=NOW()
-                         WHERE id=%s;
+                        INSERT INTO agent_settings (id, target_ids, start_message) VALUES (1, %s, %s)
+                        ON CONFLICT (id) DO UPDATE
+                           SET target_ids = EXCLUDED.target_ids,
+                               start_message = EXCLUDED.start_message,
+                               updated_at = NOW();
                         """,
-                        (target_ids, start_message, row[0]),
-                    )
-                else:
-                    cur.execute(
-                        "INSERT INTO agent_settings (target_ids, start_message) VALUES (%s, %s);",
                         (target_ids, start_message),
                     )
-    finally:
-        conn.close()
+        _settings_cache["value"] = (target_ids, start_message)
+        _settings_cache["expires"] = time.monotonic() + SETTINGS_CACHE_TTL
 
 
-def log_broadcast(chat_id, chat_type, chat_name, message, success, error_text=None):
+def log_broadcast_batch(rows):
     """
-    Пишем одну запись в историю рассылки.
+    Пишем записи в историю рассылки одним multi-row INSERT.
+    rows — список (chat_id, chat_type, chat_name, message, success, error).
     """
-    conn = get_db_conn()
-    if conn is None:
-        logger.warning("DATABASE_URL не задан — лог рассылки не сохраняется.")
+    if not rows:
         return
 
-    try:
+    with db_conn() as conn:
+        if conn is None:
+            logger.warning("DATABASE_URL не задан — лог рассылки не сохраняется.")
+            return
+
         with conn:
             with conn.cursor() as cur:
-                cur.execute(
+                execute_values(
+                    cur,
                     """
                     INSERT INTO broadcast_log
                         (chat_id, chat_type, chat_name, message, success, error)
-                    VALUES (%s, %s, %s, %s, %s, %s);
+                    VALUES %s;
                     """,
-                    (chat_id, chat_type, chat_name, message, success, error_text),
+                    rows,
+                    page_size=100,
                 )
-    finally:
-        conn.close()
+
+
+# Записи лога рассылки копятся в очереди, а отдельный поток пишет их пачками:
+# отправка сообщений не ждёт БД
+BROADCAST_LOG_BATCH = 100
+BROADCAST_LOG_FLUSH = 2.0  # сек: сколько максимум ждём добора пачки
+broadcast_log_queue = queue.Queue()
+broadcast_log_writer = {"thread": None}
+broadcast_log_writer_lock = threading.Lock()
+
+
+def _write_broadcast_log_forever():
+    # None в очереди — сигнал остановки: дописываем собранное и выходим
+    while True:
+        rows = []
+        item = broadcast_log_queue.get()
+        deadline = time.monotonic() + BROADCAST_LOG_FLUSH
+        while item is not None:
+            rows.append(item)
+            left = deadline - time.monotonic()
+            if len(rows) >= BROADCAST_LOG_BATCH or left <= 0:
+                break
+            try:
+                item = broadcast_log_queue.get(timeout=left)
+            except queue.Empty:
+                break
+
+        if rows:
+            try:
+                log_broadcast_batch(rows)
+            except Exception as e:
+                logger.exception("Ошибка записи лога рассылки (%s строк): %s", len(rows), e)
+        if item is None:
+            return
+
+
+def queue_broadcast_log(row):
+    """
+    Ставим запись (chat_id, chat_type, chat_name, message, success, error)
+    в очередь на запись; поток-писатель стартует при первом вызове.
+    """
+    with broadcast_log_writer_lock:
+        if broadcast_log_writer["thread"] is None:
+            broadcast_log_writer["thread"] = threading.Thread(
+                target=_write_broadcast_log_forever, name="broadcast-log", daemon=True
+            )
+            broadcast_log_writer["thread"].start()
+    broadcast_log_queue.put(row)
+
+
+def _stop_broadcast_log_writer():
+    # поток daemon — при остановке процесса даём ему дописать очередь
+    thread = broadcast_log_writer["thread"]
+    if thread is not None:
+        broadcast_log_queue.put(None)
+        thread.join(timeout=10)
+
+
+atexit.register(_stop_broadcast_log_writer)
 
 
 def get_broadcast_log(limit: int = 50):
     """
     Возвращаем последние записи истории рассылок.
     """
-    conn = get_db_conn()
-    if conn is None:
-        return []
+    with db_conn(autocommit=True) as conn:
+        if conn is None:
+            return []
+
+        # строки сразу приходят словарями — без пересборки в Python
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(
+                """
+                SELECT chat_id, chat_type, chat_name, message, success, error, sent_at
+                  FROM broadcast_log
+              ORDER BY sent_at DESC
+                 LIMIT %s;
+                """,
+                (limit,),
+            )
+            return cur.fetchmany(limit)
+
+
+def load_dialogue_from_db(chat_id: int):
+    """
+    Достаём сохранённую память чата: (summary, recent) или None, если её нет.
+    """
+    with db_conn(autocommit=True) as conn:
+        if conn is None:
+            return None
+
+        with conn.cursor() as cur:
+            # устаревшую память не подхватываем, даже если её ещё не вычистил prune
+            execute_prepared(
+                cur,
+                "load_dialogue",
+                """
+                SELECT summary, recent FROM dialogue_memory
+                 WHERE chat_id = $1
+                   AND ($2 = 0 OR updated_at > NOW() - $2 * INTERVAL '1 day')
+                """,
+                (chat_id, DIALOGUE_MEMORY_DAYS),
+            )
+            return cur.fetchone()
+
+
+def save_dialogue_to_db(chat_id: int, summary: str, recent: list):
+    """
+    Сохраняем память чата одним UPSERT.
+    """
+    with db_conn() as conn:
+        if conn is None:
+            return
+
+        with conn:
+            with conn.cursor() as cur:
+                execute_prepared(
+                    cur,
+                    "save_dialogue",
+                    """
+                    INSERT INTO dialogue_memory (chat_id, summary, recent)
+                    VALUES ($1, $2, $3)
+                    ON CONFLICT (chat_id) DO UPDATE
+                       SET summary = EXCLUDED.summary,
+                           recent = EXCLUDED.recent,
+                           updated_at = NOW()
+                    """,
+                    (chat_id, summary, Json(recent)),
+                )
+
+
+def prune_dialogue_memory():
+    """
+    Удаляем память чатов, молчащих дольше DIALOGUE_MEMORY_DAYS дней.
+    """
+    if DIALOGUE_MEMORY_DAYS <= 0:
+        return
+
+    with db_conn() as conn:
+        if conn is None:
+            return
 
-    try:
         with conn:
             with conn.cursor() as cur:
+                # фоновая чистка никого не задерживает, а под общим statement_timeout
+                # большая таблица не дочищалась бы никогда
                 cur.execute(
                     """
-                    SELECT chat_id, chat_type, chat_name, message, success, error, sent_at
-                      FROM broadcast_log
-                  ORDER BY sent_at DESC
-                     LIMIT %s;
+                    SET LOCAL statement_timeout = 0;
+                    DELETE FROM dialogue_memory WHERE updated_at < NOW() - %s * INTERVAL '1 day';
                     """,
-                    (limit,),
+                    (DIALOGUE_MEMORY_DAYS,),
                 )
-                rows = cur.fetchall()
-                result = []
-                for r in rows:
-                    result.append(
-                        {
-                            "chat_id": r[0],
-                            "chat_type": r[1],
-                            "chat_name": r[2],
-                            "message": r[3],
-                            "success": r[4],
-                            "error": r[5],
-                            "sent_at": r[6],
-                        }
-                    )
-                return result
-    finally:
-        conn.close()
+                if cur.rowcount:
+                    logger.info("Удалена устаревшая память %s чатов", cur.rowcount)
 
 
-# Инициализация таблиц при старте
-init_db()
+def ensure_db():
+    """
+    Создаём таблицы один раз на процесс — не при импорте, а при первой
+    реальной необходимости (старт worker'а или первый запрос к БД-странице).
+    Так web-процесс стартует, даже если Postgres ещё не поднялся.
+    """
+    if db_ready["done"]:
+        return
+    with db_ready_lock:
+        if not db_ready["done"]:
+            init_db()
+            db_ready["done"] = True
 
 
 # --- LLM-логика ---
 
-async def ask_llm(chat_id: int, user_text: str) -> str:
+@asynccontextmanager
+async def openai_slot():
     """
-    Берём актуальные тезисы из БД, собираем историю и спрашиваем OpenAI.
+    Все запросы к OpenAI идут под этим слотом: семафор ограничивает
+    одновременные запросы, а при OPENAI_RPM старты разносятся равномерно по минуте.
     """
-    if oa_client is None:
-        raise RuntimeError("OpenAI клиент не инициализирован (нет OPENAI_API_KEY)")
+    async with openai_sem:
+        if OPENAI_RPM > 0:
+            now = time.monotonic()
+            slot = max(now, openai_pace["next"])
+            openai_pace["next"] = slot + 60.0 / OPENAI_RPM
+            if slot > now:
+                await asyncio.sleep(slot - now)
+        yield
 
-    system_prompt = get_prompt_from_db() or SYSTEM_PROMPT
 
-    history = dialogues.setdefault(chat_id, [])
+async def chat_completion(**kwargs):
+    async with openai_slot():
+        return await oa_client.chat.completions.create(**kwargs)
 
-    messages = [{"role": "system", "content": system_prompt}]
-    messages.extend(history[-10:])
-    messages.append({"role": "user", "content": user_text})
 
-    resp = oa_client.chat.completions.create(
-        model=OPENAI_MODEL,
-        messages=messages,
-    )
+async def stream_completion(on_partial, **kwargs):
+    """
+    Тот же запрос, но со stream=True: по мере генерации зовём
+    on_partial(накопленный_текст), в конце возвращаем весь ответ.
+    on_partial — обычная функция: под слотом OpenAI не ждём ничего, кроме самой модели.
+    """
+    reply = ""
+    async with openai_slot():
+        stream = await oa_client.chat.completions.create(stream=True, **kwargs)
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                reply += delta
+                on_partial(reply)
+    return reply
+
 
-    reply = resp.choices[0].message.content
+@lru_cache(maxsize=4)
+def system_message(prompt: str):
+    """
+    Системное сообщение для модели. Тезисы меняются редко, поэтому один и тот же
+    dict переиспользуется между запросами (его никто не изменяет).
+    """
+    return {"role": "system", "content": prompt}
+
+
+def get_dialogue(chat_id: int):
+    """
+    Достаём память чата, заводим новую при первом сообщении.
+    dialogues работает как LRU: самый давно молчавший чат вытесняется первым —
+    и когда чатов больше DIALOGUE_MAX_CHATS, и когда он молчит дольше DIALOGUE_IDLE_TTL.
+    """
+    now = time.monotonic()
+    dialogue = dialogues.get(chat_id)
+    if dialogue is None:
+        # старые сообщения вытесняются сами, память на чат не растёт
+        dialogue = dialogues[chat_id] = {
+            "summary": "",
+            "recent": deque(maxlen=DIALOGUE_WINDOW),
+            "pending": set(),
+            "loaded": False,
+            "loading": None,
+            "used_at": now,
+            "compacting": None,
+        }
+        if len(dialogues) > DIALOGUE_MAX_CHATS:
+            dialogues.popitem(last=False)
+    else:
+        dialogues.move_to_end(chat_id)
+        dialogue["used_at"] = now
+
+    # в начале LRU — самые давно молчавшие: снимаем их, пока не встретим свежий
+    while True:
+        oldest_id, oldest = next(iter(dialogues.items()))
+        if now - oldest["used_at"] <= DIALOGUE_IDLE_TTL:
+            break
+        del dialogues[oldest_id]
+    return dialogue
+
+
+def run_in_background(coro):
+    """
+    Запускаем корутину фоном и держим ссылку на задачу, пока она не завершится
+    (иначе asyncio может собрать её сборщиком мусора посреди работы).
+    """
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+async def load_dialogue(chat_id: int, dialogue):
+    """
+    Подтягиваем память чата из БД — после рестарта worker'а или после того,
+    как чат был вытеснен из LRU. Без БД просто начинаем с чистого листа.
+    """
+    try:
+        stored = await asyncio.to_thread(load_dialogue_from_db, chat_id)
+    except Exception as e:
+        logger.warning("Не удалось загрузить память диалога %s: %s", chat_id, e)
+        return
+    finally:
+        # при ошибке следующее сообщение попробует загрузить заново
+        dialogue["loading"] = None
+
+    dialogue["loaded"] = True
+    if stored:
+        summary, recent = stored
+        dialogue["summary"] = summary or dialogue["summary"]
+        # реплики, добавленные пока шла загрузка, должны остаться последними
+        merged = [*recent, *dialogue["recent"]]
+        dialogue["recent"].clear()
+        dialogue["recent"].extend(merged)
+
+
+async def persist_dialogue(chat_id: int, dialogue):
+    try:
+        await asyncio.to_thread(
+            save_dialogue_to_db, chat_id, dialogue["summary"], list(dialogue["recent"])
+        )
+    except Exception as e:
+        logger.warning("Не удалось сохранить память диалога %s: %s", chat_id, e)
+
+
+async def compact_dialogue(dialogue):
+    """
+    Сжимаем самые старые реплики в резюме дешёвой моделью, чтобы не гонять
+    их дословно в каждый запрос. Если сжать не вышло — реплики просто
+    вытеснятся из окна, как раньше.
+    """
+    recent = dialogue["recent"]
+    if not recent:
+        # сжимать нечего — пустой запрос к модели дал бы выдуманное резюме
+        return
+    oldest = [recent.popleft() for _ in range(min(DIALOGUE_SUMMARIZE_BATCH, len(recent)))]
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in oldest)
+
+    try:
+        resp = await chat_completion(
+            model=OPENAI_SUMMARY_MODEL,
+            messages=[
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {
+                    "role": "user",
+                    "content": f"Прежнее резюме:\n{dialogue['summary'] or '—'}\n\nНовые реплики:\n{transcript}",
+                },
+            ],
+        )
+        dialogue["summary"] = resp.choices[0].message.content or dialogue["summary"]
+    except Exception as e:
+        logger.warning("Не удалось сжать историю диалога: %s", e)
+
+
+async def compact_and_persist(chat_id: int, dialogue):
+    try:
+        await compact_dialogue(dialogue)
+    finally:
+        dialogue["compacting"] = None
+    await persist_dialogue(chat_id, dialogue)
 
-    history.append({"role": "user", "content": user_text})
-    history.append({"role": "assistant", "content": reply})
+
+def history_chars(messages) -> int:
+    return sum(len(m["content"] or "") for m in messages)
+
+
+def history_within_budget(recent, budget: int):
+    """
+    Самые свежие реплики, суммарно не длиннее budget символов.
+    """
+    kept = []
+    for m in reversed(recent):
+        budget -= len(m["content"] or "")
+        if budget < 0:
+            break
+        kept.append(m)
+    kept.reverse()
+    return kept
+
+
+async def ask_llm(chat_id: int, user_text: str, on_partial=None) -> str:
+    """
+    Берём актуальные тезисы из БД, собираем историю и спрашиваем OpenAI.
+    Если передан on_partial — ответ стримится, и функция получает текст по мере генерации.
+    """
+    if oa_client is None:
+        raise RuntimeError("OpenAI клиент не инициализирован (нет OPENAI_API_KEY)")
+
+    if time.monotonic() < _prompt_cache["expires"]:
+        # кэш свежий — даже не переключаемся в поток
+        system_prompt = _prompt_cache["value"]
+    else:
+        # psycopg2 блокирующий — уводим запрос в поток, чтобы не стопорить event loop
+        system_prompt = await asyncio.to_thread(get_prompt_from_db)
+    system_prompt = system_prompt or SYSTEM_PROMPT
+
+    dialogue = get_dialogue(chat_id)
+    recent = dialogue["recent"]
+    if not dialogue["loaded"]:
+        # сообщения одного чата обрабатываются параллельно — грузим память один раз,
+        # иначе сохранённые реплики вольются в recent дважды
+        if dialogue["loading"] is None:
+            dialogue["loading"] = asyncio.ensure_future(load_dialogue(chat_id, dialogue))
+        await dialogue["loading"]
+    if dialogue["compacting"] is not None:
+        # сжатие с прошлого хода ещё идёт — дожидаемся, иначе окно переполнится
+        await dialogue["compacting"]
+    # новый ход добавит 2 реплики — если они всё же не влезут в окно (по числу или
+    # по символам), сжимаем старые прямо сейчас. Пустую историю не трогаем: длинному
+    # сообщению или DLG_WINDOW < 2 сжатие всё равно не поможет
+    if recent and (
+        len(recent) + 2 > DIALOGUE_WINDOW
+        or history_chars(recent) + len(user_text) > DIALOGUE_MAX_CHARS
+    ):
+        await compact_dialogue(dialogue)
+
+    user_msg = {"role": "user", "content": user_text}
+
+    # короткие реплики в начале диалога ("привет", "/start", "ты кто?") повторяются
+    # у разных людей — отвечаем из кэша без запроса к модели. Внутри беседы
+    # ответ зависит от истории, поэтому там кэш не используем.
+    reply = None
+    cache_key = None
+    if not recent and not dialogue["summary"] and len(user_text) < REPLY_CACHE_MAX_LEN:
+        norm = " ".join(_REPLY_PUNCT_RE.sub(" ", user_text.lower()).split())
+        # реплика из одних эмодзи/знаков нормализуется в пустую строку — такие не склеиваем.
+        # hash тезисов дешёвый (str кэширует свой hash) и меняется вместе с их текстом
+        cache_key = (hash(system_prompt), norm) if norm else None
+        cached = reply_cache.get(cache_key)
+        if cached is not None:
+            if time.monotonic() < cached[1]:
+                reply = cached[0]
+                reply_cache.move_to_end(cache_key)
+            else:
+                del reply_cache[cache_key]
+
+    if reply is None:
+        if dialogue["summary"]:
+            system_msg = {
+                "role": "system",
+                "content": f"{system_prompt}\n\nКонтекст прошлой беседы:\n{dialogue['summary']}",
+            }
+        else:
+            system_msg = system_message(system_prompt)
+
+        # если и после сжатия история длиннее бюджета — отбрасываем самые старые реплики
+        history = history_within_budget(recent, DIALOGUE_MAX_CHARS - len(user_text))
+        messages = [system_msg, *history, user_msg]
+
+        if on_partial is None:
+            resp = await chat_completion(
+                model=OPENAI_MODEL,
+                messages=messages,
+            )
+            reply = resp.choices[0].message.content
+        else:
+            reply = await stream_completion(on_partial, model=OPENAI_MODEL, messages=messages)
+
+        if cache_key is not None and reply and REPLY_CACHE_TTL > 0:
+            reply_cache[cache_key] = (reply, time.monotonic() + REPLY_CACHE_TTL)
+            if len(reply_cache) > REPLY_CACHE_SIZE:
+                reply_cache.popitem(last=False)
+
+    recent.append(user_msg)
+    recent.append({"role": "assistant", "content": reply})
+
+    # пишем в БД в фоне — ответ пользователю не ждёт этого запроса. Если для
+    # следующего хода окно уже тесное, заранее сжимаем старые реплики там же,
+    # чтобы запрос к дешёвой модели не добавлялся к задержке следующего ответа
+    if recent and (len(recent) + 2 > DIALOGUE_WINDOW or history_chars(recent) > DIALOGUE_MAX_CHARS):
+        dialogue["compacting"] = run_in_background(compact_and_persist(chat_id, dialogue))
+    else:
+        run_in_background(persist_dialogue(chat_id, dialogue))
 
     return reply
 
 
+_ID_RE = re.compile(r"-?\d+")
+# строка целиком из ID, разделённых запятыми и/или пробелами и переводами строк
+_ID_LIST_RE = re.compile(r"[\s,]*(?:-?\d+(?:[\s,]+|$))*")
+# любой фрагмент между разделителями — для поиска мусора в списке
+_ID_TOKEN_RE = re.compile(r"[^\s,]+")
+
+
+@lru_cache(maxsize=32)
 def parse_target_ids(raw: str):
+    """
+    Разбираем ID через запятую (или с новой строки). Настройки меняются редко,
+    поэтому результат кэшируется по raw и отдаётся tuple — его нельзя испортить снаружи.
+    """
+    raw = raw or ""
+    if _ID_LIST_RE.fullmatch(raw):
+        # обычный случай — все ID корректные, вытаскиваем их одной регуляркой
+        return tuple(map(int, _ID_RE.findall(raw)))
+
     ids = []
-    for part in raw.split(","):
-        part = part.strip()
-        if not part:
-            continue
-        try:
-            ids.append(int(part))
-        except ValueError:
-            logger.warning("Не удалось распарсить ID: %r", part)
-    return ids
+    for token in _ID_TOKEN_RE.findall(raw):
+        if _ID_RE.fullmatch(token):
+            ids.append(int(token))
+        else:
+            logger.warning("Не удалось распарсить ID: %r", token)
+    return tuple(ids)
 
 
 # список игнорируемых чатов (по chat_id)
@@ -373,16 +1078,92 @@ if client is not None:
             logger.info("Игнорируем сообщение из chat_id %s (IGNORE_CHAT_IDS)", chat_id)
             return
 
+        # 3) не отвечаем другим ботам — иначе два бота могут переписываться бесконечно
+        if getattr(event.sender, "bot", False):
+            logger.info("Игнорируем сообщение от бота в chat_id %s", chat_id)
+            return
+
         text = event.raw_text
 
+        # 4) стикеры, фото без подписи, служебные сообщения — модели нечего ответить
+        if not text or not text.strip():
+            logger.info("Игнорируем сообщение без текста из chat_id %s", chat_id)
+            return
+
+        # 5) тот же текст, пока на первый ещё готовится ответ, — дубль. После ответа
+        # (или ошибки) повтор обрабатываем как обычно: «да» на новый вопрос или
+        # повторная попытка после сбоя OpenAI должны получить ответ
+        dialogue = get_dialogue(chat_id)
+        if text in dialogue["pending"]:
+            logger.info("Игнорируем дубль сообщения в chat_id %s", chat_id)
+            return
+
         logger.info("Сообщение от %s: %s", chat_id, text)
 
+        # ответ стримим: первое сообщение уходит, как только набралось STREAM_FIRST_CHARS
+        # символов, дальше правим его не чаще раза в STREAM_EDIT_INTERVAL (flood-wait).
+        # Стрим OpenAI только запоминает свежий текст, а в Telegram его отправляет
+        # push_partials: flood-wait в respond/edit не держит слот OPENAI_CONCURRENCY
+        sent = {"msg": None, "text": "", "at": 0.0, "latest": "", "done": False}
+        updated = asyncio.Event()
+
+        def on_partial(partial):
+            sent["latest"] = partial
+            updated.set()
+
+        async def push_partials():
+            while True:
+                await updated.wait()
+                updated.clear()
+                if sent["done"]:
+                    return
+                if sent["msg"] is None:
+                    partial = sent["latest"]
+                    if len(partial) < STREAM_FIRST_CHARS:
+                        continue
+                    try:
+                        sent["msg"] = await event.respond(partial)
+                    except Exception as e:
+                        # весь ответ уйдёт одним сообщением, когда будет готов
+                        logger.warning("Не удалось отправить стрим-ответ в %s: %s", chat_id, e)
+                        return
+                else:
+                    wait = sent["at"] + STREAM_EDIT_INTERVAL - time.monotonic()
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                        if sent["done"]:
+                            return
+                    partial = sent["latest"]
+                    try:
+                        await sent["msg"].edit(partial)
+                    except Exception as e:
+                        logger.warning("Не удалось обновить стрим-ответ в %s: %s", chat_id, e)
+                        return
+                sent["text"] = partial
+                sent["at"] = time.monotonic()
+
+        async def stop_pushing():
+            # дожидаемся отправки, которая уже идёт, — иначе финальный ответ может
+            # уйти вторым сообщением или затереться запоздавшим edit
+            sent["done"] = True
+            updated.set()
+            await pusher
+
+        dialogue["pending"].add(text)
+        pusher = asyncio.ensure_future(push_partials())
         try:
-            reply = await ask_llm(chat_id, text)
-            await event.respond(reply)
+            reply = await ask_llm(chat_id, text, on_partial=on_partial)
+            await stop_pushing()
+            if sent["msg"] is None:
+                await event.respond(reply)
+            elif sent["text"] != reply:
+                await sent["msg"].edit(reply)
             logger.info("Ответ отправлен в %s", chat_id)
         except Exception as e:
             logger.exception("Ошибка при обработке сообщения: %s", e)
+        finally:
+            await stop_pushing()
+            dialogue["pending"].discard(text)
 
 
 async def send_initial_messages():
@@ -393,6 +1174,16 @@ async def send_initial_messages():
     return
 
 
+async def prune_dialogue_memory_forever():
+    # раз в час чистим dialogue_memory, чтобы таблица не росла с каждым новым собеседником
+    while True:
+        try:
+            await asyncio.to_thread(prune_dialogue_memory)
+        except Exception as e:
+            logger.warning("Не удалось почистить память диалогов: %s", e)
+        await asyncio.sleep(3600)
+
+
 async def main():
     if not REQUIRED_OK:
         raise RuntimeError(
@@ -402,26 +1193,177 @@ async def main():
     if client is None:
         raise RuntimeError("TelegramClient не инициализирован (проверь TG_* переменные).")
 
+    # таблицы нужны до первого входящего сообщения (память диалогов читается из БД)
+    await asyncio.to_thread(ensure_db)
+
     await client.start()
     logger.info("Telegram-агент запущен (worker)")
 
     await send_initial_messages()
-    await client.run_until_disconnected()
+    if DIALOGUE_MEMORY_DAYS > 0:
+        run_in_background(prune_dialogue_memory_forever())
+    try:
+        await client.run_until_disconnected()
+    finally:
+        # закрываем HTTP-пул AsyncOpenAI на том же loop, где он открыт,
+        # а не оставляем соединения сборщику мусора после остановки loop
+        await oa_client.close()
+
+
+# --- Вспомогательное: чтение диалогов и рассылка из веб-процесса ---
+
+# Веб-процесс держит свой TelegramClient на фоновом event loop, а Flask-потоки
+# отправляют туда корутины через run_coroutine_threadsafe. Клиент worker'а (client)
+# живёт в другом процессе (и на другом IP), обработчик сообщений висит только на нём.
+# Одна сессия, подключённая с двух IP одновременно, Telegram'ом отзывается
+# (AuthKeyDuplicatedError) — поэтому у web своя сессия TG_WEB_SESSION, а без неё
+# (запасной вариант — сессия worker'а) клиент отключается после TG_WEB_IDLE_TIMEOUT
+# секунд простоя и не висит на связи всё время жизни процесса.
+TG_WEB_SESSION = os.getenv("TG_WEB_SESSION") or TG_SESSION
+TG_WEB_IDLE_TIMEOUT = int(os.getenv("TG_WEB_IDLE_TIMEOUT", "120"))
+# users — сколько операций (страница /dialogs, рассылка) сейчас пользуются клиентом
+_tg_web = {"loop": None, "client": None, "lock": None, "idle_task": None, "users": 0, "used_at": 0.0}
+_tg_web_lock = threading.Lock()
+
+
+def _tg_web_loop():
+    with _tg_web_lock:
+        if _tg_web["loop"] is None:
+            # тот же uvloop, что и у worker'а: Telethon на нём быстрее гоняет сетевой I/O
+            loop = uvloop.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="tg-web-loop", daemon=True).start()
+            _tg_web["loop"] = loop
+        return _tg_web["loop"]
+
+
+def run_on_tg_web(coro):
+    """
+    Выполняем корутину на loop Telegram-клиента веб-процесса и ждём результат.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, _tg_web_loop()).result()
+
 
+async def web_client():
+    """
+    Общий клиент веб-процесса, при первом обращении — создаём и подключаем.
+    Выполняется только на _tg_web_loop.
+    """
+    if _tg_web["lock"] is None:
+        _tg_web["lock"] = asyncio.Lock()
+
+    async with _tg_web["lock"]:
+        if _tg_web["client"] is None:
+            if not os.getenv("TG_WEB_SESSION"):
+                logger.warning(
+                    "TG_WEB_SESSION не задан — веб использует сессию worker'а (TG_SESSION). "
+                    "Сгенерируй для веба отдельную через gen_session.py."
+                )
+            _tg_web["client"] = TelegramClient(StringSession(TG_WEB_SESSION), TG_API_ID, TG_API_HASH)
+        if not _tg_web["client"].is_connected():
+            await _tg_web["client"].connect()
+        with _tg_web_lock:
+            _tg_web["used_at"] = time.monotonic()
+        if _tg_web["idle_task"] is None:
+            _tg_web["idle_task"] = asyncio.ensure_future(_disconnect_idle_web_client())
+    return _tg_web["client"]
 
-# --- Вспомогательное: чтение диалогов и рассылка синхронно через Telethon ---
 
-def fetch_dialogs(limit: int = 50):
+async def _disconnect_idle_web_client():
     """
-    Получаем список диалогов (название + id) через синхронный клиент Telethon.
+    Отключаем клиент веб-процесса, когда он TG_WEB_IDLE_TIMEOUT секунд никому не нужен.
+    Следующий web_client() подключится заново.
     """
-    if not (TG_API_ID and TG_API_HASH and TG_SESSION):
-        return []
+    while True:
+        with _tg_web_lock:
+            idle = time.monotonic() - _tg_web["used_at"]
+            busy = _tg_web["users"] > 0
+        await asyncio.sleep(TG_WEB_IDLE_TIMEOUT if busy else max(TG_WEB_IDLE_TIMEOUT - idle, 1))
+
+        # под тем же lock, что и web_client(): клиент не отключится между
+        # подключением и выдачей его новой операции
+        async with _tg_web["lock"]:
+            with _tg_web_lock:
+                idle = time.monotonic() - _tg_web["used_at"]
+                busy = _tg_web["users"] > 0
+            if busy or idle < TG_WEB_IDLE_TIMEOUT:
+                continue
+            _tg_web["idle_task"] = None
+            await _tg_web["client"].disconnect()
+            logger.info("Telegram-клиент веб-процесса отключён после простоя")
+            return
+
 
-    dialogs_data = []
+@contextmanager
+def tg_web_client():
+    """
+    Подключённый клиент веб-процесса на время одной операции: пока она идёт,
+    клиент не отключится по простою.
+    """
+    with _tg_web_lock:
+        _tg_web["users"] += 1
     try:
-        with SyncTelegramClient(StringSession(TG_SESSION), TG_API_ID, TG_API_HASH) as sync_client:
-            for d in sync_client.iter_dialogs(limit=limit):
+        yield run_on_tg_web(web_client())
+    finally:
+        with _tg_web_lock:
+            _tg_web["users"] -= 1
+            _tg_web["used_at"] = time.monotonic()
+
+
+async def _disconnect_web_client():
+    if _tg_web["idle_task"] is not None:
+        _tg_web["idle_task"].cancel()
+    await _tg_web["client"].disconnect()
+
+
+def _close_tg_web():
+    if _tg_web["client"] is None:
+        return
+    try:
+        asyncio.run_coroutine_threadsafe(_disconnect_web_client(), _tg_web["loop"]).result(timeout=5)
+    except Exception:
+        logger.exception("Ошибка при отключении Telegram-клиента веб-процесса")
+
+
+atexit.register(_close_tg_web)
+
+
+# Последний полностью полученный список диалогов
+DIALOGS_CACHE_TTL = int(os.getenv("DIALOGS_CACHE_TTL", "60"))
+_dialogs_cache = {"data": [], "limit": 0, "expires": 0.0}
+
+
+async def _next_dialog(dialogs):
+    try:
+        return await dialogs.__anext__()
+    except StopAsyncIteration:
+        return None
+
+
+def fetch_dialogs(limit: int = 50, refresh: bool = False):
+    """
+    Отдаём диалоги (название + id) по одному, по мере ответа Telethon, —
+    страница /dialogs стримится и показывает первые строки, не дожидаясь остальных.
+    Список меняется редко, поэтому полностью полученный держим в _dialogs_cache
+    DIALOGS_CACHE_TTL секунд; refresh=True идёт в Telegram в обход кэша.
+    """
+    if not HAS_TG_CREDS:
+        return
+
+    # кэш подходит, если в нём не меньше запрошенного — или там уже все диалоги аккаунта
+    covers = _dialogs_cache["limit"] >= limit or len(_dialogs_cache["data"]) < _dialogs_cache["limit"]
+    if not refresh and covers and time.monotonic() < _dialogs_cache["expires"]:
+        yield from _dialogs_cache["data"][:limit]
+        return
+
+    data = []
+    try:
+        with tg_web_client() as tg_client:
+            dialogs = tg_client.iter_dialogs(limit=limit)
+            while True:
+                d = run_on_tg_web(_next_dialog(dialogs))
+                if d is None:
+                    break
+
                 if d.is_user:
                     d_type = "user"
                 elif d.is_group:
@@ -432,96 +1374,250 @@ def fetch_dialogs(limit: int = 50):
                     d_type = "other"
 
                 name = d.name or "(без названия)"
-                dialogs_data.append({
+                item = {
                     "id": d.id,
                     "name": name,
                     "type": d_type,
-                })
+                }
+                data.append(item)
+                yield item
+
+        # в кэш — только список, дочитанный до конца без ошибок
+        _dialogs_cache.update(data=data, limit=limit, expires=time.monotonic() + DIALOGS_CACHE_TTL)
     except Exception as e:
         logger.exception("Ошибка при получении диалогов: %s", e)
-    return dialogs_data
 
 
-def run_broadcast_now():
+async def send_broadcast(tg_client, ids, text, known=None, on_result=None):
     """
-    Запускаем рассылку из веб-интерфейса:
-      - читаем настройки из БД;
-      - шлём сообщения через SyncTelegramClient;
-      - пишем историю в broadcast_log;
-      - возвращаем (total, ok, fail).
+    Шлём text во все ids параллельно, но не больше BROADCAST_CONCURRENCY
+    отправок одновременно и не чаще BROADCAST_RATE сообщений в секунду.
+    known — {chat_id: {"type", "name"}} из fetch_dialogs: для этих чатов
+    имя и тип для лога уже есть и get_entity не нужен.
+    on_result вызывается с итогом каждой отправки сразу, как он известен.
+    Возвращаем список (chat_id, chat_type, chat_name, success, error) в порядке ids.
     """
-    if not (TG_API_ID and TG_API_HASH and TG_SESSION):
-        raise RuntimeError("Нет Telegram-кредов, рассылка невозможна.")
+    known = known or {}
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    # next — когда можно стартовать следующей отправке; flood_until — до каких пор
+    # Telegram просил паузу (FloodWait): до этого момента не шлёт никто
+    pace = {"next": 0.0, "flood_until": 0.0}
+
+    async def wait_turn():
+        # разносим отправки равномерно, чтобы не упереться в FloodWait
+        while True:
+            now = time.monotonic()
+            slot = max(now, pace["next"], pace["flood_until"])
+            if BROADCAST_RATE > 0:
+                pace["next"] = slot + 1.0 / BROADCAST_RATE
+            if slot > now:
+                await asyncio.sleep(slot - now)
+            # пока ждали слот, другая отправка могла поймать FloodWait — тогда ждём и её
+            if time.monotonic() >= pace["flood_until"]:
+                return
+
+    async def try_send(chat_id):
+        try:
+            await tg_client.send_message(chat_id, text)
+            return True
+        except FloodWaitError as e:
+            if e.seconds > BROADCAST_FLOOD_MAX_WAIT:
+                raise
+            logger.warning("Рассылка: FloodWait %s сек на %s, ждём и повторяем", e.seconds, chat_id)
+            pace["flood_until"] = max(pace["flood_until"], time.monotonic() + e.seconds)
+            return False
+
+    async def send_one(chat_id):
+        chat_name = ""
+        chat_type = ""
+        try:
+            async with sem:
+                meta = known.get(chat_id)
+                if meta is not None:
+                    chat_type, chat_name = meta["type"], meta["name"]
+                else:
+                    entity = await tg_client.get_entity(chat_id)
+                    # определяем тип и имя
+                    try:
+                        chat_name = getattr(entity, "title", None) or getattr(entity, "first_name", "") or "(без названия)"
+                    except Exception:
+                        chat_name = "(без названия)"
+
+                    if getattr(entity, "megagroup", False) or getattr(entity, "gigagroup", False):
+                        chat_type = "group"
+                    elif getattr(entity, "broadcast", False):
+                        chat_type = "channel"
+                    else:
+                        chat_type = "user"
+
+                await wait_turn()
+                sent = await try_send(chat_id)
+
+            if not sent:
+                # Telegram просит паузу — её ждём без места в семафоре, а повторяем один раз
+                await asyncio.sleep(max(pace["flood_until"] - time.monotonic(), 0))
+                async with sem:
+                    await wait_turn()
+                    await tg_client.send_message(chat_id, text)
+            logger.info("Рассылка: успешно отправлено в %s (%s)", chat_id, chat_name)
+            result = chat_id, chat_type, chat_name, True, None
+        except Exception as e:
+            logger.exception("Рассылка: ошибка отправки в %s: %s", chat_id, e)
+            result = chat_id, chat_type or "unknown", chat_name or "", False, str(e)
+
+        if on_result is not None:
+            on_result(result)
+        return result
+
+    return await asyncio.gather(*(send_one(chat_id) for chat_id in ids))
+
+
+def broadcast_targets():
+    """
+    Читаем настройки рассылки из БД и проверяем, что рассылать есть что и кому.
+    Возвращаем (ids, start_msg); ошибку настройки — ValueError с текстом для пользователя.
+    """
+    if not HAS_TG_CREDS:
+        raise ValueError("Нет Telegram-кредов, рассылка невозможна.")
 
     target_ids_str, start_msg = get_agent_settings()
     ids = parse_target_ids(target_ids_str)
 
     if not start_msg:
-        raise RuntimeError("START_MESSAGE пустой — нечего рассылать.")
+        raise ValueError("START_MESSAGE пустой — нечего рассылать.")
     if not ids:
-        raise RuntimeError("TARGET_IDS пустой — не указано, кому слать.")
+        raise ValueError("TARGET_IDS пустой — не указано, кому слать.")
+    return ids, start_msg
 
+
+def run_broadcast_now(ids, start_msg):
+    """
+    Запускаем рассылку из веб-интерфейса (цели и текст — из broadcast_targets):
+      - параллельно шлём сообщения клиентом веб-процесса (send_broadcast);
+      - пишем историю в broadcast_log;
+      - возвращаем (total, ok, fail).
+    """
     total = len(ids)
     ok = 0
     fail = 0
 
-    with SyncTelegramClient(StringSession(TG_SESSION), TG_API_ID, TG_API_HASH) as sync_client:
-        for chat_id in ids:
-            chat_name = ""
-            chat_type = ""
-            try:
-                entity = sync_client.get_entity(chat_id)
-                # определяем тип и имя
-                try:
-                    chat_name = getattr(entity, "title", None) or getattr(entity, "first_name", "") or "(без названия)"
-                except Exception:
-                    chat_name = "(без названия)"
-
-                if getattr(entity, "megagroup", False) or getattr(entity, "gigagroup", False):
-                    chat_type = "group"
-                elif getattr(entity, "broadcast", False):
-                    chat_type = "channel"
-                else:
-                    chat_type = "user"
+    # имена и типы чатов для лога берём из диалогов одним запросом,
+    # а не get_entity на каждую цель
+    known = {d["id"]: d for d in fetch_dialogs(limit=BROADCAST_DIALOGS_LIMIT)}
 
-                sync_client.send_message(chat_id, start_msg)
-                ok += 1
-                log_broadcast(chat_id, chat_type, chat_name, start_msg, True, None)
-                logger.info("Рассылка: успешно отправлено в %s (%s)", chat_id, chat_name)
-            except Exception as e:
-                fail += 1
-                err_text = str(e)
-                log_broadcast(chat_id, chat_type or "unknown", chat_name or "", start_msg, False, err_text)
-                logger.exception("Рассылка: ошибка отправки в %s: %s", chat_id, e)
+    def log_result(result):
+        # история пишется фоновым потоком пачками, по мере отправки
+        chat_id, chat_type, chat_name, success, err_text = result
+        queue_broadcast_log((chat_id, chat_type, chat_name, start_msg, success, err_text))
+
+    with tg_web_client() as tg_client:
+        results = run_on_tg_web(send_broadcast(tg_client, ids, start_msg, known, log_result))
+
+    for _, _, _, success, _ in results:
+        if success:
+            ok += 1
+        else:
+            fail += 1
 
     return total, ok, fail
 
 
+# Рассылка может идти минутами — выполняем её в фоновом потоке, чтобы POST /broadcast
+# не держал поток gunicorn; итог показываем на странице рассылки.
+# Одновременно идёт не больше одной: повторный POST, пока первая не кончилась,
+# ничего не запускает (иначе двойной клик = двойная рассылка).
+broadcast_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="broadcast")
+broadcast_status = {"running": None, "last": None}
+broadcast_status_lock = threading.Lock()
+
+
+def _broadcast_done(fut):
+    try:
+        total, ok, fail = fut.result()
+        last = f"Последняя рассылка: всего {total}, успешно {ok}, ошибок {fail}."
+    except Exception as e:
+        logger.exception("Ошибка при рассылке: %s", e)
+        last = f"Ошибка при рассылке: {e}"
+
+    with broadcast_status_lock:
+        broadcast_status["running"] = None
+        broadcast_status["last"] = last
+
+
+def start_broadcast() -> bool:
+    """
+    Запускаем рассылку в фоне. False — если предыдущая ещё идёт.
+    Настройки проверяем сразу, до запуска: ошибку в них (ValueError) страница
+    показывает тут же, а не «рассылка запущена» с ошибкой в итоге.
+    """
+    ids, start_msg = broadcast_targets()
+    with broadcast_status_lock:
+        if broadcast_status["running"] is not None:
+            return False
+        fut = broadcast_status["running"] = broadcast_executor.submit(run_broadcast_now, ids, start_msg)
+    fut.add_done_callback(_broadcast_done)
+    return True
+
+
 # --- Flask веб-интерфейс ---
 
 app = Flask(__name__)
 app.secret_key = os.getenv("FLASK_SECRET", "change-me")
+# static/style.css почти не меняется — браузер держит его сутки и не перезапрашивает
+app.config["SEND_FILE_MAX_AGE_DEFAULT"] = 86400
+# Страницы ссылаются на style.css?v=<хэш содержимого>: новый CSS — новый URL,
+# поэтому такой URL браузер может кэшировать «навсегда» (см. cache_static_forever)
+STATIC_MAX_AGE = 31536000
+with open(os.path.join(app.static_folder, "style.css"), "rb") as f:
+    STATIC_VERSION = hashlib.sha1(f.read()).hexdigest()[:12]
 
 
-INDEX_HTML = """
+# Общий каркас страниц: <head> со стилями и карточка, страницы заполняют блоки
+BASE_HTML = """
 <!doctype html>
 <html lang="ru">
 <head>
   <meta charset="utf-8">
-  <title>Telegram AI Agent — статус</title>
+  <title>{% block title %}{% endblock %}</title>
+  <link rel="stylesheet" href="{{ url_for('static', filename='style.css', v=static_version) }}">
 </head>
-<body style="font-family: system-ui, -apple-system; background:#111827; color:#e5e7eb;">
-  <div style="max-width:860px;margin:40px auto;padding:24px;border-radius:16px;background:#020617;border:1px solid #1f2937;">
-    <div style="display:flex;justify-content:space-between;align-items:center;gap:12px;">
+<body{% block body_attrs %}{% endblock %}>
+  <div class="card">
+    {% block content %}{% endblock %}
+  </div>
+</body>
+</html>
+"""
+
+
+FLASHES_HTML = """
+{% with messages = get_flashed_messages() %}
+  {% if messages %}
+    <div class="flash">
+      {% for m in messages %}
+        {{ m }}
+      {% endfor %}
+    </div>
+  {% endif %}
+{% endwith %}
+"""
+
+
+INDEX_HTML = """
+{% extends "base.html" %}
+{% block title %}Telegram AI Agent — статус{% endblock %}
+{% block body_attrs %} class="status"{% endblock %}
+{% block content %}
+    <div class="head">
       <div>
-        <h1 style="margin:0 0 4px 0;font-size:24px;">Telegram AI Agent</h1>
-        <div style="color:#9ca3af;font-size:14px;">Статус приложения и быстрые ссылки.</div>
+        <h1>Telegram AI Agent</h1>
+        <div class="muted">Статус приложения и быстрые ссылки.</div>
       </div>
-      <div style="display:flex;gap:8px;flex-wrap:wrap;">
-        <a href="{{ url_for('edit_prompt') }}" style="padding:6px 12px;border-radius:999px;border:1px solid #374151;color:#e5e7eb;text-decoration:none;font-size:13px;">✏️ Тезисы для ИИ</a>
-        <a href="{{ url_for('settings_page') }}" style="padding:6px 12px;border-radius:999px;border:1px solid #374151;color:#e5e7eb;text-decoration:none;font-size:13px;">🎯 Цели рассылки</a>
-        <a href="{{ url_for('dialogs_page') }}" style="padding:6px 12px;border-radius:999px;border:1px solid #374151;color:#e5e7eb;text-decoration:none;font-size:13px;">📚 Диалоги Telegram</a>
-        <a href="{{ url_for('broadcast_page') }}" style="padding:6px 12px;border-radius:999px;border:1px solid #22c55e;color:#bbf7d0;text-decoration:none;font-size:13px;">▶️ Рассылка</a>
+      <div class="pills">
+        <a href="{{ url_for('edit_prompt') }}" class="pill">✏️ Тезисы для ИИ</a>
+        <a href="{{ url_for('settings_page') }}" class="pill">🎯 Цели рассылки</a>
+        <a href="{{ url_for('dialogs_page') }}" class="pill">📚 Диалоги Telegram</a>
+        <a href="{{ url_for('broadcast_page') }}" class="pill pill-go">▶️ Рассылка</a>
       </div>
     </div>
 
@@ -539,226 +1635,190 @@ INDEX_HTML = """
       <li>START_MESSAGE (env): {{ 'задано' if start_message else 'пусто' }}</li>
       <li>SYSTEM_PROMPT (env): {{ 'задан' if system_prompt else 'по умолчанию' }}</li>
       <li>IGNORE_CHAT_IDS (env): {{ ignore_chat_ids_raw or 'пусто' }}</li>
+      <li>TG_WEB_SESSION (env): {{ 'задан' if has_tg_web_session else 'нет — веб использует TG_SESSION' }}</li>
     </ul>
 
-    <p style="font-size:13px;color:#9ca3af;">
+    <p class="hint">
       Реальные значения для стартовой рассылки и тезисов берутся из базы (страницы «Тезисы для ИИ» и «Цели рассылки»).<br>
       Worker обрабатывает <b>только личные чаты</b>; группы и каналы он игнорирует. Рассылка стартует вручную на странице «Рассылка».
     </p>
-  </div>
-</body>
-</html>
+{% endblock %}
 """
 
 
 PROMPT_HTML = """
-<!doctype html>
-<html lang="ru">
-<head>
-  <meta charset="utf-8">
-  <title>Тезисы для ИИ — Telegram Agent</title>
-</head>
-<body style="font-family: system-ui, -apple-system; background:#020617; color:#e5e7eb;">
-  <div style="max-width:840px;margin:40px auto;padding:24px;border-radius:16px;background:#020617;border:1px solid #1f2937;">
-    <h1 style="margin-top:0;font-size:22px;">Тезисы для ИИ</h1>
-    <p style="color:#9ca3af;font-size:14px;">
+{% extends "base.html" %}
+{% block title %}Тезисы для ИИ — Telegram Agent{% endblock %}
+{% block content %}
+    <h1>Тезисы для ИИ</h1>
+    <p class="muted">
       Здесь ты задаёшь, <b>о чём именно должен говорить агент</b> и как себя вести.<br>
       Этот текст попадает в системный промпт модели и влияет на все ответы.
     </p>
 
-    {% with messages = get_flashed_messages() %}
-      {% if messages %}
-        <div style="margin:8px 0 12px 0;color:#bbf7d0;font-size:13px;">
-          {% for m in messages %}
-            {{ m }}
-          {% endfor %}
-        </div>
-      {% endif %}
-    {% endwith %}
+    {% include "flashes.html" %}
 
     <form method="post">
-      <div style="margin-bottom:8px;font-size:13px;color:#9ca3af;">Основные тезисы и правила общения:</div>
-      <textarea name="content" rows="16" style="width:100%;border-radius:12px;border:1px solid #374151;background:#020617;color:#e5e7eb;padding:10px;font-size:14px;resize:vertical;">{{ content or "" }}</textarea>
-      <div style="margin-top:12px;display:flex;gap:12px;align-items:center;">
-        <button type="submit" style="border:none;border-radius:999px;padding:8px 18px;background:#2563eb;color:#fff;font-size:14px;cursor:pointer;">
+      <div class="label">Основные тезисы и правила общения:</div>
+      <textarea name="content" rows="16">{{ content or "" }}</textarea>
+      <div class="actions">
+        <button type="submit" class="btn btn-blue">
           💾 Сохранить
         </button>
-        <a href="{{ url_for('index') }}" style="font-size:13px;color:#9ca3af;text-decoration:none;">← Назад к статусу</a>
+        <a href="{{ url_for('index') }}" class="back">← Назад к статусу</a>
       </div>
     </form>
-  </div>
-</body>
-</html>
+{% endblock %}
 """
 
 
 SETTINGS_HTML = """
-<!doctype html>
-<html lang="ru">
-<head>
-  <meta charset="utf-8">
-  <title>Цели рассылки — Telegram Agent</title>
-</head>
-<body style="font-family: system-ui, -apple-system; background:#020617; color:#e5e7eb;">
-  <div style="max-width:840px;margin:40px auto;padding:24px;border-radius:16px;background:#020617;border:1px solid #1f2937;">
-    <h1 style="margin-top:0;font-size:22px;">Цели рассылки и первое сообщение</h1>
-    <p style="color:#9ca3af;font-size:14px;">
+{% extends "base.html" %}
+{% block title %}Цели рассылки — Telegram Agent{% endblock %}
+{% block content %}
+    <h1>Цели рассылки и первое сообщение</h1>
+    <p class="muted">
       Здесь ты задаёшь, <b>кому агент пишет первым</b> и какой текст отправляет при запуске рассылки.<br>
-      Формат списка ID: <code>123456789,-1002222333444</code> (через запятую).
+      Формат списка ID: <code>123456789,-1002222333444</code> (через запятую или каждый с новой строки).
     </p>
 
-    {% with messages = get_flashed_messages() %}
-      {% if messages %}
-        <div style="margin:8px 0 12px 0;color:#bbf7d0;font-size:13px;">
-          {% for m in messages %}
-            {{ m }}
-          {% endfor %}
-        </div>
-      {% endif %}
-    {% endwith %}
+    {% include "flashes.html" %}
 
     <form method="post">
-      <div style="margin-bottom:6px;font-size:13px;color:#9ca3af;">Список chat_id (юзеры, группы, каналы) через запятую:</div>
-      <textarea name="target_ids" rows="3" style="width:100%;border-radius:12px;border:1px solid #374151;background:#020617;color:#e5e7eb;padding:10px;font-size:14px;resize:vertical;">{{ target_ids or "" }}</textarea>
+      <div class="label">Список chat_id (юзеры, группы, каналы) через запятую или с новой строки:</div>
+      <textarea name="target_ids" rows="3">{{ target_ids or "" }}</textarea>
 
-      <div style="margin:12px 0 6px 0;font-size:13px;color:#9ca3af;">Текст первого сообщения (START_MESSAGE):</div>
-      <textarea name="start_message" rows="5" style="width:100%;border-radius:12px;border:1px solid #374151;background:#020617;color:#e5e7eb;padding:10px;font-size:14px;resize:vertical;">{{ start_message or "" }}</textarea>
+      <div class="label">Текст первого сообщения (START_MESSAGE):</div>
+      <textarea name="start_message" rows="5">{{ start_message or "" }}</textarea>
 
-      <div style="margin-top:12px;display:flex;gap:12px;align-items:center;">
-        <button type="submit" style="border:none;border-radius:999px;padding:8px 18px;background:#16a34a;color:#fff;font-size:14px;cursor:pointer;">
+      <div class="actions">
+        <button type="submit" class="btn btn-green">
           💾 Сохранить настройки
         </button>
-        <a href="{{ url_for('index') }}" style="font-size:13px;color:#9ca3af;text-decoration:none;">← Назад к статусу</a>
+        <a href="{{ url_for('index') }}" class="back">← Назад к статусу</a>
       </div>
     </form>
 
-    <p style="margin-top:18px;font-size:13px;color:#9ca3af;">
+    <p class="note">
       Чтобы увидеть названия групп и их ID, открой страницу «Диалоги Telegram».
     </p>
-  </div>
-</body>
-</html>
+{% endblock %}
 """
 
 
 DIALOGS_HTML = """
-<!doctype html>
-<html lang="ru">
-<head>
-  <meta charset="utf-8">
-  <title>Диалоги Telegram — Telegram Agent</title>
-</head>
-<body style="font-family: system-ui, -apple-system; background:#020617; color:#e5e7eb;">
-  <div style="max-width:880px;margin:40px auto;padding:24px;border-radius:16px;background:#020617;border:1px solid #1f2937;">
-    <h1 style="margin-top:0;font-size:22px;">Диалоги Telegram</h1>
-    <p style="color:#9ca3af;font-size:14px;">
+{% extends "base.html" %}
+{% block title %}Диалоги Telegram — Telegram Agent{% endblock %}
+{% block content %}
+    <h1>Диалоги Telegram</h1>
+    <p class="muted">
       Список последних диалогов аккаунта агента. Отсюда можно копировать <code>chat_id</code> и вставлять в «Цели рассылки».
     </p>
 
     {% if not has_creds %}
-      <p style="color:#fecaca;font-size:14px;">
+      <p class="muted err">
         TG_API_ID / TG_API_HASH / TG_SESSION не заданы — получить диалоги невозможно.
       </p>
     {% else %}
-      {% if not dialogs %}
-        <p style="color:#9ca3af;font-size:14px;">
-          Диалоги не найдены или произошла ошибка при запросе. Попробуй позже или проверь логи.
-        </p>
-      {% else %}
-        <table style="width:100%;border-collapse:collapse;font-size:13px;margin-top:12px;">
-          <thead>
+      <p class="small">
+        <a href="{{ url_for('dialogs_page', refresh=1, limit=limit) }}" class="link">↻ Обновить из Telegram</a>
+      </p>
+      <table>
+        <thead>
+          <tr>
+            <th>Тип</th>
+            <th>Название</th>
+            <th>chat_id</th>
+          </tr>
+        </thead>
+        <tbody>
+          {% for d in dialogs %}
             <tr>
-              <th style="text-align:left;border-bottom:1px solid #1f2937;padding:6px;">Тип</th>
-              <th style="text-align:left;border-bottom:1px solid #1f2937;padding:6px;">Название</th>
-              <th style="text-align:left;border-bottom:1px solid #1f2937;padding:6px;">chat_id</th>
+              <td>{{ d.type }}</td>
+              <td>{{ d.name }}</td>
+              <td><code>{{ d.id }}</code></td>
             </tr>
-          </thead>
-          <tbody>
-            {% for d in dialogs %}
-              <tr>
-                <td style="padding:6px;border-bottom:1px solid #111827;">{{ d.type }}</td>
-                <td style="padding:6px;border-bottom:1px solid #111827;">{{ d.name }}</td>
-                <td style="padding:6px;border-bottom:1px solid #111827;"><code>{{ d.id }}</code></td>
-              </tr>
-            {% endfor %}
-          </tbody>
-        </table>
+          {% else %}
+            <tr>
+              <td colspan="3" class="muted">
+                Диалоги не найдены или произошла ошибка при запросе. Попробуй позже или проверь логи.
+              </td>
+            </tr>
+          {% endfor %}
+        </tbody>
+      </table>
+      {% if next_limit %}
+        <p class="small">
+          <a href="{{ url_for('dialogs_page', limit=next_limit) }}" class="link">Показать ещё</a>
+        </p>
       {% endif %}
     {% endif %}
 
-    <p style="margin-top:18px;font-size:13px;color:#9ca3af;">
+    <p class="note">
       После обновления целей рассылки используй страницу «Рассылка», чтобы отправить сообщения.
     </p>
 
-    <p style="font-size:13px;">
-      <a href="{{ url_for('index') }}" style="color:#9ca3af;text-decoration:none;">← Назад к статусу</a>
+    <p class="small">
+      <a href="{{ url_for('index') }}" class="back">← Назад к статусу</a>
     </p>
-  </div>
-</body>
-</html>
+{% endblock %}
 """
 
 
 BROADCAST_HTML = """
-<!doctype html>
-<html lang="ru">
-<head>
-  <meta charset="utf-8">
-  <title>Рассылка — Telegram Agent</title>
-</head>
-<body style="font-family: system-ui, -apple-system; background:#020617; color:#e5e7eb;">
-  <div style="max-width:900px;margin:40px auto;padding:24px;border-radius:16px;background:#020617;border:1px solid #1f2937;">
-    <h1 style="margin-top:0;font-size:22px;">Рассылка</h1>
-    <p style="color:#9ca3af;font-size:14px;">
+{% extends "base.html" %}
+{% block title %}Рассылка — Telegram Agent{% endblock %}
+{% block content %}
+    <h1>Рассылка</h1>
+    <p class="muted">
       Эта страница запускает рассылку по текущим настройкам (страница «Цели рассылки»).
     </p>
 
-    {% with messages = get_flashed_messages() %}
-      {% if messages %}
-        <div style="margin:8px 0 12px 0;color:#bbf7d0;font-size:13px;">
-          {% for m in messages %}
-            {{ m }}
-          {% endfor %}
-        </div>
-      {% endif %}
-    {% endwith %}
+    {% include "flashes.html" %}
 
     <form method="post">
-      <p style="font-size:13px;color:#fbbf24;">
-        Перед запуском убедись, что правильно заполнены <a href="{{ url_for('settings_page') }}" style="color:#93c5fd;">цели рассылки</a>.
+      <p class="warn">
+        Перед запуском убедись, что правильно заполнены <a href="{{ url_for('settings_page') }}" class="link">цели рассылки</a>.
       </p>
-      <button type="submit" style="border:none;border-radius:999px;padding:10px 22px;background:#22c55e;color:#022c22;font-size:15px;cursor:pointer;">
+      <button type="submit" class="btn btn-go">
         ▶️ Запустить рассылку сейчас
       </button>
     </form>
 
-    <h2 style="margin-top:24px;font-size:18px;">История рассылок (последние {{ logs|length }})</h2>
+    {% if broadcast.running %}
+      <p class="warn">⏳ Рассылка выполняется — обнови страницу, чтобы увидеть итог.</p>
+    {% endif %}
+    {% if broadcast.last %}
+      <p class="hint">{{ broadcast.last }}</p>
+    {% endif %}
+
+    <h2>История рассылок (последние {{ logs|length }})</h2>
 
     {% if not logs %}
-      <p style="color:#9ca3af;font-size:14px;">Пока нет записей. Запусти первую рассылку.</p>
+      <p class="muted">Пока нет записей. Запусти первую рассылку.</p>
     {% else %}
-      <table style="width:100%;border-collapse:collapse;font-size:13px;margin-top:12px;">
+      <table>
         <thead>
           <tr>
-            <th style="text-align:left;border-bottom:1px solid #1f2937;padding:6px;">Время</th>
-            <th style="text-align:left;border-bottom:1px solid #1f2937;padding:6px;">Тип</th>
-            <th style="text-align:left;border-bottom:1px solid #1f2937;padding:6px;">Чат</th>
-            <th style="text-align:left;border-bottom:1px solid #1f2937;padding:6px;">chat_id</th>
-            <th style="text-align:left;border-bottom:1px solid #1f2937;padding:6px;">Статус</th>
+            <th>Время</th>
+            <th>Тип</th>
+            <th>Чат</th>
+            <th>chat_id</th>
+            <th>Статус</th>
           </tr>
         </thead>
         <tbody>
           {% for r in logs %}
             <tr>
-              <td style="padding:6px;border-bottom:1px solid #111827;">{{ r.sent_at }}</td>
-              <td style="padding:6px;border-bottom:1px solid #111827;">{{ r.chat_type }}</td>
-              <td style="padding:6px;border-bottom:1px solid #111827;">{{ r.chat_name }}</td>
-              <td style="padding:6px;border-bottom:1px solid #111827;"><code>{{ r.chat_id }}</code></td>
-              <td style="padding:6px;border-bottom:1px solid #111827;">
+              <td>{{ r.sent_at }}</td>
+              <td>{{ r.chat_type }}</td>
+              <td>{{ r.chat_name }}</td>
+              <td><code>{{ r.chat_id }}</code></td>
+              <td>
                 {% if r.success %}
-                  <span style="color:#4ade80;">успех</span>
+                  <span class="ok">успех</span>
                 {% else %}
-                  <span style="color:#fecaca;" title="{{ r.error or '' }}">ошибка</span>
+                  <span class="err" title="{{ r.error or '' }}">ошибка</span>
                 {% endif %}
               </td>
             </tr>
@@ -767,32 +1827,78 @@ BROADCAST_HTML = """
       </table>
     {% endif %}
 
-    <p style="margin-top:18px;font-size:13px;color:#9ca3af;">
+    <p class="note">
       Если какие-то отправки не прошли (ошибка), наведи курсор на «ошибка» чтобы увидеть текст.
     </p>
 
-    <p style="font-size:13px;">
-      <a href="{{ url_for('index') }}" style="color:#9ca3af;text-decoration:none;">← Назад к статусу</a>
+    <p class="small">
+      <a href="{{ url_for('index') }}" class="back">← Назад к статусу</a>
     </p>
-  </div>
-</body>
-</html>
+{% endblock %}
 """
 
 
+# base.html и flashes.html — общие части страниц, через {% extends %} / {% include %}
+app.jinja_loader = DictLoader({"base.html": BASE_HTML, "flashes.html": FLASHES_HTML})
+app.jinja_env.globals["static_version"] = STATIC_VERSION
+
+
+@app.before_request
+def init_db_on_first_request():
+    # статус-странице и статике БД не нужна, остальные страницы работают с таблицами
+    if request.endpoint not in ("index", "static"):
+        ensure_db()
+
+
+@app.after_request
+def cache_static_forever(resp):
+    # версионированный CSS не меняется под тем же URL — браузеру незачем даже перепроверять его
+    if request.endpoint == "static" and request.args.get("v") == STATIC_VERSION:
+        resp.cache_control.public = True
+        resp.cache_control.max_age = STATIC_MAX_AGE
+        resp.cache_control.immutable = True
+    return resp
+
+
+@lru_cache(maxsize=None)
+def page_template(source: str):
+    """
+    Шаблон компилируется один раз, при первом рендере страницы, а не на каждый запрос.
+    Не при импорте: worker тоже импортирует этот модуль, но страниц не отдаёт.
+    """
+    return app.jinja_env.from_string(source)
+
+
+# Значения для статус-страницы: считаются один раз, env в процессе не меняются
+STATUS = {
+    "has_tg_api_id": bool(TG_API_ID),
+    "has_tg_api_hash": bool(TG_API_HASH),
+    "has_tg_session": bool(TG_SESSION),
+    "has_tg_web_session": bool(os.getenv("TG_WEB_SESSION")),
+    "has_openai_key": bool(OPENAI_API_KEY),
+    "target_ids_raw": TARGET_IDS_RAW,
+    # шаблону нужна только «задано/нет» — не тащим тексты через autoescape
+    "start_message": bool(START_MESSAGE),
+    "system_prompt": bool(SYSTEM_PROMPT),
+    "ignore_chat_ids_raw": IGNORE_CHAT_IDS_RAW,
+}
+
+# Статус зависит только от env, которые без рестарта не меняются, —
+# рендерим страницу при первом запросе и дальше отдаём готовый HTML;
+# ETag + Cache-Control дают браузеру/роутеру отвечать 304 без тела
+index_page = {"html": None, "etag": None}
+
+
 @app.route("/")
 def index():
-    return render_template_string(
-        INDEX_HTML,
-        has_tg_api_id=bool(TG_API_ID),
-        has_tg_api_hash=bool(TG_API_HASH),
-        has_tg_session=bool(TG_SESSION),
-        has_openai_key=bool(OPENAI_API_KEY),
-        target_ids_raw=TARGET_IDS_RAW,
-        start_message=START_MESSAGE,
-        system_prompt=SYSTEM_PROMPT,
-        ignore_chat_ids_raw=IGNORE_CHAT_IDS_RAW,
-    )
+    if index_page["html"] is None:
+        index_page["html"] = page_template(INDEX_HTML).render(**STATUS)
+        index_page["etag"] = hashlib.sha1(index_page["html"].encode()).hexdigest()
+
+    resp = make_response(index_page["html"])
+    resp.set_etag(index_page["etag"])
+    resp.headers["Cache-Control"] = "public, max-age=60"
+    return resp.make_conditional(request)
 
 
 @app.route("/prompt", methods=["GET", "POST"])
@@ -808,7 +1914,7 @@ def edit_prompt():
         return redirect(url_for("edit_prompt"))
 
     current = get_prompt_from_db() or SYSTEM_PROMPT
-    return render_template_string(PROMPT_HTML, content=current)
+    return page_template(PROMPT_HTML).render(content=current)
 
 
 @app.route("/settings", methods=["GET", "POST"])
@@ -825,38 +1931,59 @@ def settings_page():
         return redirect(url_for("settings_page"))
 
     ids, msg = get_agent_settings()
-    return render_template_string(
-        SETTINGS_HTML,
+    return page_template(SETTINGS_HTML).render(
         target_ids=ids,
         start_message=msg,
     )
 
 
+# /dialogs показывает диалоги страницами по DIALOGS_PAGE_SIZE, но не больше DIALOGS_MAX
+DIALOGS_PAGE_SIZE = 20
+DIALOGS_MAX = 200
+
+
 @app.route("/dialogs")
 def dialogs_page():
-    has_creds = bool(TG_API_ID and TG_API_HASH and TG_SESSION)
-    dialogs = fetch_dialogs(limit=50) if has_creds else []
-    return render_template_string(
-        DIALOGS_HTML,
+    refresh = request.args.get("refresh") == "1"
+    # по умолчанию — первая страница; больше подгружаем по ссылке «показать ещё»
+    limit = min(max(request.args.get("limit", DIALOGS_PAGE_SIZE, type=int), 1), DIALOGS_MAX)
+    dialogs = fetch_dialogs(limit=limit, refresh=refresh) if HAS_TG_CREDS else ()
+    # строки уходят браузеру по мере получения диалогов от Telegram
+    stream = page_template(DIALOGS_HTML).stream(
         dialogs=dialogs,
-        has_creds=has_creds,
+        has_creds=HAS_TG_CREDS,
+        limit=limit,
+        next_limit=min(limit + DIALOGS_PAGE_SIZE, DIALOGS_MAX) if limit < DIALOGS_MAX else None,
     )
+    stream.enable_buffering(5)
+    return Response(stream_with_context(stream))
 
 
 @app.route("/broadcast", methods=["GET", "POST"])
 def broadcast_page():
     if request.method == "POST":
         try:
-            total, ok, fail = run_broadcast_now()
-            flash(f"Рассылка запущена. Всего: {total}, успешно: {ok}, ошибок: {fail}.")
+            if start_broadcast():
+                flash("Рассылка запущена, итог появится на этой странице.")
+            else:
+                flash("Рассылка уже идёт — дождись её окончания.")
+        except ValueError as e:
+            logger.warning("Рассылка не запущена: %s", e)
+            flash(f"Ошибка при запуске рассылки: {e}")
         except Exception as e:
             logger.exception("Ошибка при запуске рассылки: %s", e)
             flash(f"Ошибка при запуске рассылки: {e}")
         return redirect(url_for("broadcast_page"))
 
     logs = get_broadcast_log(limit=50)
-    return render_template_string(BROADCAST_HTML, logs=logs)
+    with broadcast_status_lock:
+        broadcast = {
+            "running": broadcast_status["running"] is not None,
+            "last": broadcast_status["last"],
+        }
+    return page_template(BROADCAST_HTML).render(logs=logs, broadcast=broadcast)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # uvloop (libuv) вместо стандартного цикла — быстрее на сетевом I/O Telethon и OpenAI
+    uvloop.run(main())
@@ -13,6 +13,9 @@ if not (TG_API_ID and TG_API_HASH):
 
 with TelegramClient(StringSession(), TG_API_ID, TG_API_HASH) as client:
     session_str = client.session.save()
-    print("\nВставь это значение в переменную TG_SESSION (локально и на Heroku):\n")
+    # worker и веб работают с разных IP — каждому нужна своя сессия, иначе
+    # Telegram отзовёт ключ (AuthKeyDuplicatedError). Запусти скрипт дважды.
+    print("\nВставь это значение в переменную TG_SESSION (worker) или, при втором запуске,")
+    print("в TG_WEB_SESSION (веб-интерфейс) — локально и на Heroku:\n")
     print(session_str)
     print("\nНЕ показывай это никому.\n")